@@ -10,26 +10,45 @@
 
 from Core import Core as Token
 from Scanner import Scanner
+from collections import deque
+import io
 import sys
 
 
+# Raised for errors found while executing the program. Parse and
+# semantic errors still exit directly, execution errors propagate up
+# to execute_tree so buffered output is written before the message
+class ExecError(RuntimeError):
+    pass
+
+
 class Parser:
 
     # Default constructor
     #   scanner         -   holds scanner object
-    #   tree            -   parse tree representation through program.nodes
+    #   tree            -   parse tree rooted at the Program node
     #   global_scope    -   root of the present scope of the tree
-    #   data            -   holds queue from user data file
-    def __init__(self, f_name):
+    #   data            -   holds deque of ints from user data file
+    #   ids             -   maps each id name to its dense slot index
+    #   out_buf         -   collects program output until execution ends,
+    #                       None when buffering is disabled
+    #   write           -   output sink used by Output statements
+    def __init__(self, f_name, buffered=True):
         self.scanner = Scanner(f_name)
         self.tree = Program()
         self.global_scope = scope_tree()
         self.data = None
+        self.ids = {}
+        self.out_buf = io.StringIO() if buffered else None
+        self.write = self.out_buf.write if buffered else sys.stdout.write
 
-    # Constructs the parse tree and runs semantic checks
+    # Constructs the parse tree, runs semantic checks, then lowers
+    # the tree into pre-bound execution closures
     def build_tree(self):
         self.tree.parse(self)
+        self.global_scope = scope_tree(len(self.ids))
         self.tree.semantics(self)
+        self.tree.compile()
 
     # Prints the token and its correct formatting
     def print_tree(self):
@@ -39,8 +58,23 @@ class Parser:
     def execute_tree(self, f_name):
         # Read data and reset global scope
         self.data = Parser.clean_data(f_name)
-        self.global_scope = scope_tree()
-        self.tree.execute(self)
+        self.global_scope.clear()
+        # Output produced before an execution error is still written
+        # ahead of the error message
+        error = None
+        try:
+            self.tree.execute(self)
+        except ExecError as e:
+            error = e
+        finally:
+            if self.out_buf is not None:
+                sys.stdout.write(self.out_buf.getvalue())
+                self.out_buf.seek(0)
+                self.out_buf.truncate()
+        if error is not None:
+            sys.stdout.flush()
+            print(error, file=sys.stderr)
+            sys.exit(1)
 
     # Accesses present token
     def token(self):
@@ -50,6 +84,11 @@ class Parser:
     def get_id(self):
         return self.scanner.getID()
 
+    # Returns the slot index of an id name, assigning the next free
+    # index the first time the name is seen
+    def intern(self, name):
+        return self.ids.setdefault(name, len(self.ids))
+
     # Get current token CONST
     def get_const(self):
         return self.scanner.getCONST()
@@ -63,6 +102,12 @@ class Parser:
         if self.token() != expected:
             sys.exit(f'\nERROR: Token {self.token().name} was invalidly placed, expected {expected.name}')
 
+    # Consumes a token after validating it, for nodes which keep their
+    # children in named attributes rather than a node list
+    def token_consume(self, expected):
+        self.token_validate(expected)
+        self.next_token()
+
     # Consumes a token after validating it, additionally add the node
     # to the parse tree
     #   expected            -   expected Token enum reference
@@ -73,59 +118,57 @@ class Parser:
         self.next_token()
 
     @staticmethod
-    # DFS search of the present nested scopes. Starts from root
-    # and works down the tree returning the deepest element which
-    # contains the variable of interest. Else returns None.
-    #   tree    -   root of parse tree
-    #   var     -   id to query
-    def dfs_scope(tree, var):
-        sub = None
-        if tree.child is not None:
-            sub = Parser.dfs_scope(tree.child, var)
-        if sub is not None and var in sub.dict:
-            return sub
-        if var in tree.dict:
-            return tree
+    # Lexical search of the present nested scopes. Starts from the
+    # innermost scope and walks up the parent chain returning the
+    # first element which contains the variable of interest. Else
+    # returns None.
+    #   scope   -   innermost scope of the caller
+    #   var     -   slot index of the id to query
+    def scope_lookup(scope, var):
+        while scope is not None:
+            if scope.mask[var]:
+                return scope
+            scope = scope.parent
         return None
 
     @staticmethod
     # Quickly read out the consts from the user file
-    # and tokenizes into integer representation
+    # and tokenizes into a queue of integers
     def clean_data(f_name):
         scan = open(f_name, 'r')
         text = scan.read()
         scan.close()
-        consts = text.split(' ')
-        for c in consts:
-            c = int(c)
-        return consts
+        return deque(int(c) for c in text.split())
 
 
 # Class for the program grammar portion. Will address all variables
 # for the parse and semantics section since they're homogenized across
 # all of the classes.
 class Program:
+    __slots__ = ('decls', 'stmts', 'program_scope', 'space', 'code')
+
     # Default constructor
-    #   nodes           -   nested queue representation of parse tree
+    #   decls           -   declaration sequence before begin
+    #   stmts           -   statement sequence between begin and end
     #   program_scope   -   first nested scope for after begin
     #   space           -   counter for indentation printing
+    #   code            -   compiled declaration callable and tuple of
+    #                       statement callables
     def __init__(self):
-        self.nodes = []
+        self.decls = DeclSeq()
+        self.stmts = StmtSeq()
         self.program_scope = scope_tree()
         self.space = 0
+        self.code = None
 
     # Parses the program grammar portion
     #   parser          -   parser object
     def parse(self, parser):
-        parser.token_assert(Token.PROGRAM, self.nodes)
-        # Works by pushing the current class object into the node queue,
-        # then calling the parse function of the newly added object
-        self.nodes.append(DeclSeq())
-        self.nodes[-1].parse(parser)
-        parser.token_assert(Token.BEGIN, self.nodes)
-        self.nodes.append(StmtSeq())
-        self.nodes[-1].parse(parser)
-        parser.token_assert(Token.END, self.nodes)
+        parser.token_consume(Token.PROGRAM)
+        self.decls.parse(parser)
+        parser.token_consume(Token.BEGIN)
+        self.stmts.parse(parser)
+        parser.token_consume(Token.END)
         if parser.token() != Token.ERROR:
             sys.exit(f'\nERROR: Declarations following end statement.\n')
 
@@ -137,49 +180,58 @@ class Program:
     #   scope           -   scope from parent class like program, if, or
     #                       while to simply string out of scope variables
     def semantics(self, parser, parent=None, scope=None):
-        scope = parser.global_scope
-        for node in self.nodes:
-            if node is Token.BEGIN:
-                scope = self.program_scope
-                parser.global_scope.child = scope
-            if type(node) != Token:
-                node.semantics(parser, None, scope)
+        self.program_scope = scope_tree(len(parser.ids))
+        self.decls.semantics(parser, None, parser.global_scope)
+        self.enter_scope(parser)
+        self.stmts.semantics(parser, None, self.program_scope)
 
     # Prints the representation of the parse tre
     def print(self):
-        for node in self.nodes:
-            if type(node) == DeclSeq:
-                node.print(self.space + 1)
-            elif type(node) == StmtSeq:
-                node.print(self.space + 1)
-            elif type(node) == Token:
-                print(f'{node.value}')
-
-    # Executes the program from the parse tree.
+        print(f'{Token.PROGRAM.value}')
+        self.decls.print(self.space + 1)
+        print(f'{Token.BEGIN.value}')
+        self.stmts.print(self.space + 1)
+        print(f'{Token.END.value}')
+
+    # Compiles the declarations and statements once. The split between
+    # the two is fixed by the grammar, so execute needs no per node
+    # checks for where the program scope begins
+    def compile(self):
+        self.stmts.compile()
+        self.code = (self.decls.compile(), self.stmts.code)
+
+    # Links the program scope beneath the global scope once the
+    # declarations have been executed
+    def enter_scope(self, parser):
+        parser.global_scope.child = self.program_scope
+        self.program_scope.parent = parser.global_scope
+
+    # Executes the program from the compiled callables.
     #   parser          -   parser object
     #   caller          -   analog to the parent variable in semantics
     #   scope           -   analog to scope variable in semantics
     def execute(self, parser, caller=None, scope=None):
-        scope = parser.global_scope
-        self.program_scope = scope_tree()
-        for node in self.nodes:
-            if node is Token.BEGIN:
-                scope = self.program_scope
-                parser.global_scope.child = scope
-            if type(node) is not Token:
-                node.execute(parser, caller, scope)
+        decls, stmts = self.code
+        scope = self.program_scope
+        scope.clear()
+        decls(parser, None, parser.global_scope)
+        self.enter_scope(parser)
+        for stmt in stmts:
+            stmt(parser, None, scope)
 
 
 # Redirects to Decl
 class DeclSeq:
+    __slots__ = ('nodes',)
+
     def __init__(self):
         self.nodes = []
 
     def parse(self, parser):
         self.nodes.append(Decl())
         self.nodes[-1].parse(parser)
-        if parser.token() != Token.BEGIN:
-            self.nodes.append(DeclSeq())
+        while parser.token() != Token.BEGIN:
+            self.nodes.append(Decl())
             self.nodes[-1].parse(parser)
 
     def semantics(self, parser, parent=None, scope=None):
@@ -192,6 +244,12 @@ class DeclSeq:
             if type(node) is not Token:
                 node.print(indent)
 
+    def compile(self):
+        for node in self.nodes:
+            if type(node) is not Token:
+                node.compile()
+        return self.execute
+
     def execute(self, parser, caller=None, local=None):
         for node in self.nodes:
             if type(node) is not Token:
@@ -200,6 +258,8 @@ class DeclSeq:
 
 # Redirects to IdList
 class Decl:
+    __slots__ = ('nodes',)
+
     def __init__(self):
         self.nodes = []
 
@@ -227,6 +287,17 @@ class Decl:
             else:
                 print(f'{node.value}')
 
+    # Declarations are reported as writes since they can shadow a
+    # name read by an enclosing loop condition
+    def writes(self):
+        return self.nodes[1].writes()
+
+    def compile(self):
+        for node in self.nodes:
+            if type(node) is not Token:
+                node.compile()
+        return self.execute
+
     def execute(self, parser, caller=None, local=None):
         for node in self.nodes:
             if type(node) is not Token:
@@ -234,15 +305,17 @@ class Decl:
 
 
 class IdList:
+    __slots__ = ('nodes',)
+
     def __init__(self):
         self.nodes = []
 
     def parse(self, parser):
         self.nodes.append(Id())
         self.nodes[-1].parse(parser)
-        if parser.token() == Token.COMMA:
+        while parser.token() == Token.COMMA:
             parser.token_assert(Token.COMMA, self.nodes)
-            self.nodes.append(IdList())
+            self.nodes.append(Id())
             self.nodes[-1].parse(parser)
 
     def semantics(self, parser, parent=None, scope=None):
@@ -257,6 +330,19 @@ class IdList:
             else:
                 print(f'{node.value}', end='')
 
+    def writes(self):
+        names = set()
+        for node in self.nodes:
+            if type(node) is Id:
+                names.add(node.name)
+        return names
+
+    def compile(self):
+        for node in self.nodes:
+            if type(node) is not Token:
+                node.compile()
+        return self.execute
+
     def execute(self, parser, caller=None, local=None):
         for node in self.nodes:
             if type(node) is not Token:
@@ -264,86 +350,119 @@ class IdList:
 
 
 class Id:
+    __slots__ = ('name', 'idx', '_scope')
+
+    # Default constructor
+    #   name            -   string name of the id
+    #   idx             -   slot index of the name in every scope_tree
+    #   _scope          -   scope the id resolved to during semantics,
+    #                       None if it did not resolve. If, While and
+    #                       Program reuse their scope objects at runtime,
+    #                       so this is the scope execute looks in
     def __init__(self):
-        self.nodes = []
+        self.name = None
+        self.idx = None
+        self._scope = None
 
     def parse(self, parser):
         parser.token_validate(Token.ID)
-        self.nodes.append(Token.ID)
-        self.nodes.append(parser.get_id())
+        self.name = parser.get_id()
+        self.idx = parser.intern(self.name)
         parser.next_token()
 
     def semantics(self, parser, parent, scope=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                # Find lowest scope of declaration
-                tree = Parser.dfs_scope(parser.global_scope, node)
-                # Verify variable has been declared and instantiated
-                if parent == 'get':
-                    if tree is None or not tree.dict[node]:
-                        sys.exit(f'ERROR: Variable {node} not instantiated')
-                # Verify variable doesn't exist in current scope
-                elif parent == 'declare':
-                    if node not in scope.dict:
-                        scope.dict[node] = False
-                    else:
-                        sys.exit(f'ERROR: Variable {node} declared twice within the same scope.')
-                # Assign lowest possible scope or raise flag
-                elif parent == 'assign':
-                    if tree is None:
-                        sys.exit(f'ERROR: Variable {node} not declared in any scope.')
-                    tree.dict[node] = True
+        node, idx = self.name, self.idx
+        # Find lowest scope of declaration and keep it for execution
+        tree = Parser.scope_lookup(scope, idx)
+        self._scope = tree
+        # Verify variable has been declared and instantiated
+        if parent == 'get':
+            if tree is None or not tree.slots[idx]:
+                sys.exit(f'ERROR: Variable {node} not instantiated')
+        # Verify variable doesn't exist in current scope
+        elif parent == 'declare':
+            if not scope.mask[idx]:
+                scope.declare(idx, False)
+            else:
+                sys.exit(f'ERROR: Variable {node} declared twice within the same scope.')
+        # Assign lowest possible scope or raise flag
+        elif parent == 'assign':
+            if tree is None:
+                sys.exit(f'ERROR: Variable {node} not declared in any scope.')
+            tree.slots[idx] = True
 
     def print(self, indent=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                print(node, end='')
+        print(self.name, end='')
+
+    def reads(self):
+        return {self.name}
+
+    def source(self, env, cached=None):
+        if cached and self.name in cached:
+            env.append(self.compile_get(cached))
+            return f'_k{len(env) - 1}(parser, None, local)'
+        env.append(self.execute)
+        return f"_k{len(env) - 1}(parser, 'get', local)"
+
+    def compile(self):
+        return self.execute
+
+    # Callable reading the id's value. A loop invariant id reads through
+    # its cache cell, resolving the value only when the cell is empty
+    def compile_get(self, cached=None):
+        get = self.execute
+        if cached and self.name in cached:
+            cell = cached[self.name]
+
+            def execute(parser, caller=None, local=None):
+                if cell[0] is None:
+                    cell[0] = get(parser, 'get', local)
+                return cell[0]
+            return execute
+        return lambda parser, caller=None, local=None: get(parser, 'get', local)
 
     def execute(self, parser, caller=None, local=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                tree = Parser.dfs_scope(parser.global_scope, node)
-                if caller == 'get':
-                    if tree is None or tree.dict[node] is None:
-                        sys.exit(f'ERROR: Variable {node} not instantiated')
-                    return tree.dict[node]
-                elif caller == 'declare':
-                    if node not in local.dict:
-                        local.dict[node] = None
-                    else:
-                        sys.exit(f'ERROR: Variable {node} declared twice within the same scope.')
-                elif caller == 'assign':
-                    if tree is None:
-                        sys.exit(f'ERROR: Variable {node} not declared in any scope.')
-                    return node, tree
+        idx = self.idx
+        if caller == 'declare':
+            if not local.mask[idx]:
+                local.declare(idx, None)
+            else:
+                raise ExecError(f'ERROR: Variable {self.name} declared twice within the same scope.')
+            return
+        # Use the statically resolved scope. Semantics sees declarations
+        # from both branches of an If, so a runtime scope can only resolve
+        # at or above it; search upward when it is not there
+        tree = self._scope
+        if tree is None:
+            tree = Parser.scope_lookup(local, idx)
+        elif not tree.mask[idx]:
+            tree = Parser.scope_lookup(tree, idx)
+        if caller == 'get':
+            if tree is None or tree.slots[idx] is None:
+                raise ExecError(f'ERROR: Variable {self.name} not instantiated')
+            return tree.slots[idx]
+        elif caller == 'assign':
+            if tree is None:
+                raise ExecError(f'ERROR: Variable {self.name} not declared in any scope.')
+            return idx, tree
 
 
 class StmtSeq:
+    __slots__ = ('nodes', 'code')
+
     def __init__(self):
         self.nodes = []
+        self.code = ()
 
     def parse(self, parser):
-        if parser.token() == Token.ID:
-            self.nodes.append(Assign())
-        elif parser.token() == Token.INPUT:
-            self.nodes.append(Input())
-        elif parser.token() == Token.OUTPUT:
-            self.nodes.append(Output())
-        elif parser.token() == Token.IF:
-            self.nodes.append(If())
-        elif parser.token() == Token.WHILE:
-            self.nodes.append(While())
-        elif parser.token() == Token.INT:
-            self.nodes.append(Decl())
-        else:
-            sys.exit("ERROR: Bad start to statement: " + parser.scanner.token().name + "\n")
-        self.nodes[-1].parse(parser)
-        if (not parser.token() == Token.END
-                and not parser.token() == Token.ENDIF
-                and not parser.token() == Token.ENDWHILE
-                and not parser.token() == Token.ELSE):
-            self.nodes.append(StmtSeq())
+        while True:
+            stmt = _STMT_DISPATCH.get(parser.token())
+            if stmt is None:
+                sys.exit("ERROR: Bad start to statement: " + parser.token().name + "\n")
+            self.nodes.append(stmt())
             self.nodes[-1].parse(parser)
+            if parser.token() in (Token.END, Token.ENDIF, Token.ENDWHILE, Token.ELSE):
+                break
 
     def semantics(self, parser, parent=None, scope=None):
         for node in self.nodes:
@@ -353,54 +472,71 @@ class StmtSeq:
         for node in self.nodes:
             node.print(indent)
 
-    def execute(self, parser, caller=None, local=None):
+    def writes(self):
+        names = set()
         for node in self.nodes:
-            node.execute(parser, caller, local)
+            names |= node.writes()
+        return names
+
+    def compile(self):
+        self.code = tuple(node.compile() for node in self.nodes)
+        return self.execute
+
+    def execute(self, parser, caller=None, local=None):
+        for stmt in self.code:
+            stmt(parser, caller, local)
 
 
 class Assign:
+    __slots__ = ('id', 'expr')
+
+    # Default constructor
+    #   id          -   target Id
+    #   expr        -   Expr whose value is assigned
     def __init__(self):
-        self.nodes = []
+        self.id = Id()
+        self.expr = Expr()
 
     def parse(self, parser):
-        self.nodes.append(Id())
-        self.nodes[-1].parse(parser)
-        parser.token_assert(Token.ASSIGN, self.nodes)
-        self.nodes.append(Expr())
-        self.nodes[-1].parse(parser)
-        parser.token_assert(Token.SEMICOLON, self.nodes)
+        self.id.parse(parser)
+        parser.token_consume(Token.ASSIGN)
+        self.expr.parse(parser)
+        parser.token_consume(Token.SEMICOLON)
 
     def semantics(self, parser, parent=None, scope=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.semantics(parser, 'assign', scope)
+        self.id.semantics(parser, 'assign', scope)
+        self.expr.semantics(parser, 'assign', scope)
 
     def print(self, indent):
         for i in range(indent):
             print('\t', end='')
-        for node in self.nodes:
-            if type(node) is Token:
-                if node == Token.ASSIGN:
-                    print(f'{node.value}', end='')
-                else:
-                    print(f'{node.value}')
-            else:
-                node.print(indent)
+        self.id.print(indent)
+        print(f'{Token.ASSIGN.value}', end='')
+        self.expr.print(indent)
+        print(f'{Token.SEMICOLON.value}')
 
-    def execute(self, parser, caller=None, local=None):
-        var, tree, expr = '', None, 0
-        for node in self.nodes:
-            if type(node) is Id:
-                var, tree = node.execute(parser, 'assign', local)
-            elif type(node) is Expr:
-                expr = node.execute(parser, caller, local)
-        tree.dict[var] = expr
+    def writes(self):
+        return {self.id.name}
+
+    # Binds the target and expression callables directly so the
+    # statement no longer looks them up on every execution
+    def compile(self):
+        target, expr = self.id.compile(), self.expr.compile()
+
+        def execute(parser, caller=None, local=None):
+            var, tree = target(parser, 'assign', local)
+            tree.slots[var] = expr(parser, caller, local)
+        return execute
 
 
 class If:
+    __slots__ = ('nodes', 'local', '_cond', '_then', '_else', 'code')
+
     def __init__(self):
         self.nodes = []
         self.local = scope_tree()
+        self._cond, self._then, self._else = None, None, None
+        self.code = ()
 
     def parse(self, parser):
         parser.token_assert(Token.IF, self.nodes)
@@ -413,10 +549,14 @@ class If:
             parser.token_assert(Token.ELSE, self.nodes)
             self.nodes.append(StmtSeq())
             self.nodes[-1].parse(parser)
+            self._else = self.nodes[-1]
         parser.token_assert(Token.ENDIF, self.nodes)
+        self._cond, self._then = self.nodes[1], self.nodes[3]
 
     def semantics(self, parser, parent=None, scope=None):
+        self.local = scope_tree(len(parser.ids))
         scope.child = self.local
+        self.local.parent = scope
         for node in self.nodes:
             if type(node) is not Token:
                 node.semantics(parser, parent, self.local)
@@ -447,24 +587,39 @@ class If:
                         print('\t', end='')
                     print(f'{node.value}')
 
+    def writes(self):
+        names = set()
+        for node in self.nodes:
+            if type(node) is StmtSeq:
+                names |= node.writes()
+        return names
+
+    def compile(self):
+        self.code = (self._cond.compile(), self._then.compile(),
+                     self._else.compile() if self._else is not None else None)
+        return self.execute
+
     def execute(self, parser, caller=None, local=None):
-        self.local = scope_tree()
+        self.local.clear()
         local.child = self.local
-        truth, index = True, 1
-        truth = self.nodes[index].execute(parser, caller, self.local)
-        index += 2
-        if truth:
-            self.nodes[index].execute(parser, caller, self.local)
-        elif self.nodes[index+1] == Token.ELSE:
-            index += 2
-            self.nodes[index].execute(parser, caller, self.local)
+        self.local.parent = local
+        cond, then, other = self.code
+        if cond(parser, caller, self.local):
+            then(parser, caller, self.local)
+        elif other is not None:
+            other(parser, caller, self.local)
         local.child = None
 
 
 class While:
+    __slots__ = ('nodes', 'local', '_cond', '_body', '_hoisted', 'code')
+
     def __init__(self):
         self.nodes = []
         self.local = scope_tree()
+        self._cond, self._body = None, None
+        self._hoisted = {}
+        self.code = ()
 
     def parse(self, parser):
         parser.token_assert(Token.WHILE, self.nodes)
@@ -474,9 +629,12 @@ class While:
         self.nodes.append(StmtSeq())
         self.nodes[-1].parse(parser)
         parser.token_assert(Token.ENDWHILE, self.nodes)
+        self._cond, self._body = self.nodes[1], self.nodes[3]
 
     def semantics(self, parser, parent=None, scope=None):
+        self.local = scope_tree(len(parser.ids))
         scope.child = self.local
+        self.local.parent = scope
         for node in self.nodes:
             if type(node) is not Token:
                 node.semantics(parser, parent, self.local)
@@ -501,19 +659,36 @@ class While:
                         print('\t', end='')
                     print(f'{node.value}')
 
+    def writes(self):
+        return self._body.writes()
+
+    # Ids read by the condition but never written or declared in the
+    # body are loop invariant, so they are cached rather than resolved
+    # again on every iteration. Each gets a one element cache cell that
+    # the compiled condition fills on first use and execute resets, so
+    # the parse tree itself is left untouched
+    def compile(self):
+        invariant = self._cond.reads() - self._body.writes()
+        self._hoisted = {name: [None] for name in invariant}
+        self.code = (self._cond.compile(self._hoisted), self._body.compile())
+        return self.execute
+
     def execute(self, parser, caller=None, local=None):
-        self.local = scope_tree()
+        self.local.clear()
         local.child = self.local
-        index = 1
-        cond = self.nodes[1]
-        index += 2
-        stmt = self.nodes[index]
-        while cond.execute(parser, caller, self.local):
-            stmt.execute(parser, caller, local)
+        self.local.parent = local
+        for cell in self._hoisted.values():
+            cell[0] = None
+        (cond, body), scope = self.code, self.local
+        while cond(parser, caller, scope):
+            body(parser, caller, scope)
+            scope.clear()
         local.child = None
 
 
 class Input:
+    __slots__ = ('nodes',)
+
     def __init__(self):
         self.nodes = []
 
@@ -539,18 +714,24 @@ class Input:
             else:
                 print(f'{node.value}')
 
+    def writes(self):
+        return {self.nodes[1].name}
+
+    def compile(self):
+        self.nodes[1].compile()
+        return self.execute
+
     def execute(self, parser, caller=None, local=None):
-        var, tree = '', None
-        for node in self.nodes:
-            if type(node) is Id:
-                var, tree = node.execute(parser, 'assign', local)
-        if len(parser.data) > 0:
-            tree.dict[var] = parser.data.pop(0)
+        var, tree = self.nodes[1].execute(parser, 'assign', local)
+        if parser.data:
+            tree.slots[var] = parser.data.popleft()
         else:
-            sys.exit('ERROR: Insufficient entries in data file to complete.')
+            raise ExecError('ERROR: Insufficient entries in data file to complete.')
 
 
 class Output:
+    __slots__ = ('nodes',)
+
     def __init__(self):
         self.nodes = []
 
@@ -576,146 +757,250 @@ class Output:
             else:
                 print(f'{node.value}')
 
-    def execute(self, parser, caller=None, local=None):
-        print(self.nodes[1].execute(parser, 'get', local))
+    @staticmethod
+    def writes():
+        return set()
+
+    def compile(self):
+        expr = self.nodes[1].compile()
+        return lambda parser, caller=None, local=None: parser.write(f"{expr(parser, 'get', local)}\n")
 
 
+# Holds the whole chain of terms in one node rather than nesting an
+# Expr per operator. Operators still group to the right, so a - b - c
+# evaluates as a - (b - c)
+#   terms       -   Term children in source order
+#   ops         -   ADD/SUB tokens between consecutive terms
 class Expr:
+    __slots__ = ('terms', 'ops')
+
     def __init__(self):
-        self.nodes = []
+        self.terms = []
+        self.ops = []
 
     def parse(self, parser):
-        self.nodes.append(Term())
-        self.nodes[-1].parse(parser)
-        if parser.token() == Token.ADD:
-            parser.token_assert(Token.ADD, self.nodes)
-            self.nodes.append(Expr())
-            self.nodes[-1].parse(parser)
-        elif parser.token() == Token.SUB:
-            parser.token_assert(Token.SUB, self.nodes)
-            self.nodes.append(Expr())
-            self.nodes[-1].parse(parser)
+        self.terms.append(Term())
+        self.terms[-1].parse(parser)
+        while parser.token() in (Token.ADD, Token.SUB):
+            self.ops.append(parser.token())
+            parser.next_token()
+            self.terms.append(Term())
+            self.terms[-1].parse(parser)
 
     def semantics(self, parser, parent, scope=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.semantics(parser, parent, scope)
+        for term in self.terms:
+            term.semantics(parser, parent, scope)
 
     def print(self, indent=None):
-        for node in self.nodes:
-            if type(node) is Token:
-                print(f'{node.value}', end='')
-            else:
-                node.print()
-
-    def execute(self, parser, caller=None, local=None):
-        val = self.nodes[0].execute(parser, 'expr', local)
-        if len(self.nodes) > 1:
-            if self.nodes[1] is Token.ADD:
-                val += self.nodes[2].execute(parser, caller, local)
-            elif self.nodes[1] is Token.SUB:
-                val -= self.nodes[2].execute(parser, caller, local)
-        return val
+        self.terms[0].print()
+        for op, term in zip(self.ops, self.terms[1:]):
+            print(f'{op.value}', end='')
+            term.print()
+
+    def reads(self):
+        names = set()
+        for term in self.terms:
+            names |= term.reads()
+        return names
+
+    # Lowers the whole expression to one python code object so the
+    # arithmetic runs as a single frame rather than a closure call per
+    # node. Constants are inlined and ids become calls to their compiled
+    # getters, bound as _k0, _k1, ... in the code's globals. Expressions
+    # nested too deeply for the python compiler keep the closure form.
+    #   cached      -   cache cells of loop invariant ids by name, None
+    #                   outside a While condition
+    def compile(self, cached=None):
+        env = []
+        try:
+            code = compile(f'lambda parser, caller=None, local=None: {self.source(env, cached)}',
+                           '<expr>', 'eval')
+        except (SyntaxError, RecursionError, MemoryError):
+            return self.compile_closures(cached)
+        return eval(code, {f'_k{i}': fn for i, fn in enumerate(env)})
+
+    # Pairs each term with whether it is subtracted. The right grouping
+    # is distributed up front: a term is subtracted when an odd number
+    # of SUB tokens precede it. Both compile paths read signs from here
+    def signed_terms(self):
+        signed, negate = [(False, self.terms[0])], False
+        for op, term in zip(self.ops, self.terms[1:]):
+            negate ^= op is Token.SUB
+            signed.append((negate, term))
+        return signed
+
+    # Python source for the expression, appending every callable it
+    # references to env
+    def source(self, env, cached=None):
+        src = []
+        for negate, term in self.signed_terms():
+            if src:
+                src.append('-' if negate else '+')
+            src.append(term.source(env, cached))
+        return f'({" ".join(src)})'
+
+    # Fallback for expressions too deep to lower to source. A lone term
+    # is executed directly, otherwise the signed terms are added or
+    # subtracted in order by one loop
+    def compile_closures(self, cached=None):
+        if len(self.terms) == 1:
+            return self.terms[0].compile(cached)
+        signed = tuple((negate, term.compile(cached)) for negate, term in self.signed_terms())
+
+        def execute(parser, caller=None, local=None):
+            val = 0
+            for negate, term in signed:
+                if negate:
+                    val -= term(parser, 'expr', local)
+                else:
+                    val += term(parser, 'expr', local)
+            return val
+        return execute
 
 
+# Holds the whole chain of factors in one node
+#   factors     -   Factor children in source order, joined by MULT
+#   code        -   compiled factor callables
 class Term:
+    __slots__ = ('factors', 'code')
+
     def __init__(self):
-        self.nodes = []
+        self.factors = []
+        self.code = ()
 
     def parse(self, parser):
-        self.nodes.append(Factor())
-        self.nodes[-1].parse(parser)
-        if parser.token() == Token.MULT:
-            parser.token_assert(Token.MULT, self.nodes)
-            self.nodes.append(Term())
-            self.nodes[-1].parse(parser)
+        self.factors.append(Factor())
+        self.factors[-1].parse(parser)
+        while parser.token() == Token.MULT:
+            parser.next_token()
+            self.factors.append(Factor())
+            self.factors[-1].parse(parser)
 
     def semantics(self, parser, parent, scope=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.semantics(parser, parent, scope)
+        for factor in self.factors:
+            factor.semantics(parser, parent, scope)
 
     def print(self, indent=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.print()
-            else:
-                print(f'{node.value}', end='')
+        self.factors[0].print()
+        for factor in self.factors[1:]:
+            print(f'{Token.MULT.value}', end='')
+            factor.print()
+
+    def reads(self):
+        names = set()
+        for factor in self.factors:
+            names |= factor.reads()
+        return names
+
+    def source(self, env, cached=None):
+        return f'({" * ".join(factor.source(env, cached) for factor in self.factors)})'
+
+    def compile(self, cached=None):
+        self.code = tuple(factor.compile(cached) for factor in self.factors)
+        if len(self.code) == 1:
+            return self.code[0]
+        return self.execute
 
     def execute(self, parser, caller=None, local=None):
-        val = self.nodes[0].execute(parser, caller, local)
-        if len(self.nodes) > 1 and self.nodes[1] is Token.MULT:
-            val *= self.nodes[2].execute(parser, caller, local)
+        val = 1
+        for factor in self.code:
+            val *= factor(parser, caller, local)
         return val
 
 
+# Single operand of a Term
+#   child       -   Id, Const or the parenthesised Expr
 class Factor:
+    __slots__ = ('child',)
+
     def __init__(self):
-        self.nodes = []
+        self.child = None
 
     def parse(self, parser):
         if parser.token() == Token.ID:
-            self.nodes.append(Id())
-            self.nodes[-1].parse(parser)
+            self.child = Id()
+            self.child.parse(parser)
         elif parser.token() == Token.CONST:
-            self.nodes.append(Const())
-            self.nodes[-1].parse(parser)
+            self.child = Const()
+            self.child.parse(parser)
         elif parser.token() == Token.LPAREN:
             self.expr_paren_parse(parser)
         else:
             sys.exit('ERROR: Invalid operator received.')
 
     def semantics(self, parser, parent, scope=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.semantics(parser, parent, scope)
+        self.child.semantics(parser, parent, scope)
 
+    # Parenthesised expressions hold exactly one Expr, nesting is left
+    # to the Expr itself
     def expr_paren_parse(self, parser):
-        parser.token_assert(Token.LPAREN, self.nodes)
-        self.nodes.append(Expr())
-        self.nodes[-1].parse(parser)
-        if parser.token() == Token.LPAREN:
-            self.expr_paren_parse(parser)
-        parser.token_assert(Token.RPAREN, self.nodes)
+        parser.token_consume(Token.LPAREN)
+        self.child = Expr()
+        self.child.parse(parser)
+        parser.token_consume(Token.RPAREN)
 
     def print(self, indent=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.print()
-            else:
-                print(f'{node.value}', end='')
-
-    def execute(self, parser, caller=None, local=None):
-        if type(self.nodes[0]) is Const:
-            return self.nodes[0].execute(parser, caller, local)
-        elif type(self.nodes[0]) is Id:
-            return self.nodes[0].execute(parser, 'get', local)
+        if type(self.child) is Expr:
+            print(f'{Token.LPAREN.value}', end='')
+            self.child.print()
+            print(f'{Token.RPAREN.value}', end='')
         else:
-            return self.nodes[1].execute(parser, caller, local)
+            self.child.print()
+
+    def reads(self):
+        return self.child.reads()
+
+    def source(self, env, cached=None):
+        return self.child.source(env, cached)
 
+    # The kind of factor is fixed once parsed, so compile hands back
+    # the child's callable instead of dispatching on its type per call
+    def compile(self, cached=None):
+        if type(self.child) is Id:
+            return self.child.compile_get(cached)
+        return self.child.compile(cached)
 
+
+# Holds the whole chain of OR operands in one node. Every operand is a
+# Cmpr except possibly the last, which is a negated Cond
+#   nodes       -   operands interleaved with OR tokens, for printing
+#   terms       -   operands in source order
+#   negate      -   True for the !(Cond) form, whose sole term is the
+#                   inner Cond
 class Cond:
+    __slots__ = ('nodes', 'terms', 'negate')
+
     def __init__(self):
         self.nodes = []
+        self.terms = []
+        self.negate = False
 
     def parse(self, parser):
         if parser.token() == Token.NEGATION:
             parser.token_assert(Token.NEGATION, self.nodes)
+            self.negate = True
             self.cond_paren_parse(parser)
-        else:
-            self.nodes.append(Cmpr())
-            self.nodes[-1].parse(parser)
-            if parser.token() == Token.OR:
-                parser.token_assert(Token.OR, self.nodes)
-                self.nodes.append(Cond())
-                self.nodes[-1].parse(parser)
+            return
+        self.terms.append(Cmpr())
+        self.nodes.append(self.terms[-1])
+        self.terms[-1].parse(parser)
+        while parser.token() == Token.OR:
+            parser.token_assert(Token.OR, self.nodes)
+            if parser.token() == Token.NEGATION:
+                self.terms.append(Cond())
+            else:
+                self.terms.append(Cmpr())
+            self.nodes.append(self.terms[-1])
+            self.terms[-1].parse(parser)
+            if type(self.terms[-1]) is Cond:
+                break
 
+    # A negation holds exactly one parenthesised Cond, matching Factor
     def cond_paren_parse(self, parser):
         parser.token_assert(Token.LPAREN, self.nodes)
-        self.nodes.append(Cond())
-        self.nodes[-1].parse(parser)
-        if parser.token() == Token.LPAREN:
-            self.cond_paren_parse(parser)
+        self.terms.append(Cond())
+        self.nodes.append(self.terms[-1])
+        self.terms[-1].parse(parser)
         parser.token_assert(Token.RPAREN, self.nodes)
 
     def semantics(self, parser, parent='call', scope=None):
@@ -730,62 +1015,92 @@ class Cond:
             else:
                 print(f'{node.value}', end='')
 
-    def execute(self, parser, caller=None, local=None):
-        val = None
-        if self.nodes[0] is not Token.NEGATION:
-            val = self.nodes[0].execute(parser, caller, local)
-            if len(self.nodes) > 1 and self.nodes[1] is Token.OR:
-                val |= self.nodes[2].execute(parser, caller, local)
-        else:
-            val = not (self.nodes[2].execute(parser, caller, local))
-        return val
-
-
+    def reads(self):
+        names = set()
+        for node in self.nodes:
+            if type(node) is not Token:
+                names |= node.reads()
+        return names
+
+    # A negation or lone operand binds straight to its operand. An OR
+    # chain short circuits on the first operand that holds
+    def compile(self, cached=None):
+        terms = tuple(term.compile(cached) for term in self.terms)
+        if self.negate:
+            inner = terms[0]
+            return lambda parser, caller=None, local=None: not inner(parser, caller, local)
+        elif len(terms) == 1:
+            return terms[0]
+
+        def execute(parser, caller=None, local=None):
+            for term in terms:
+                if term(parser, caller, local):
+                    return True
+            return False
+        return execute
+
+
+# Comparison of two expressions
+#   left        -   Expr on the left of the comparator
+#   op          -   EQUAL, LESS or LESSEQUAL token
+#   right       -   Expr on the right of the comparator
 class Cmpr:
+    __slots__ = ('left', 'op', 'right')
+
     def __init__(self):
-        self.nodes = []
+        self.left = Expr()
+        self.op = None
+        self.right = Expr()
 
     def parse(self, parser):
-        self.nodes.append(Expr())
-        self.nodes[-1].parse(parser)
-        if parser.token() == Token.EQUAL:
-            parser.token_assert(Token.EQUAL, self.nodes)
-        elif parser.token() == Token.LESS:
-            parser.token_assert(Token.LESS, self.nodes)
-        elif parser.token() == Token.LESSEQUAL:
-            parser.token_assert(Token.LESSEQUAL, self.nodes)
-        self.nodes.append(Expr())
-        self.nodes[-1].parse(parser)
+        self.left.parse(parser)
+        if parser.token() not in (Token.EQUAL, Token.LESS, Token.LESSEQUAL):
+            sys.exit('ERROR: Invalid comparator received.')
+        self.op = parser.token()
+        parser.next_token()
+        self.right.parse(parser)
 
     def semantics(self, parser, parent='call', scope=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.semantics(parser, parent, scope)
+        self.left.semantics(parser, parent, scope)
+        self.right.semantics(parser, parent, scope)
 
     def print(self, indent=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                node.print()
-            else:
-                print(f'{node.value}', end='')
-
-    def execute(self, parser, caller=None, local=None):
-        expr = self.nodes[0].execute(parser, caller, local)
-        if self.nodes[1] is Token.LESS:
-            return expr < self.nodes[2].execute(parser, caller, local)
-        elif self.nodes[1] is Token.EQUAL:
-            return expr == self.nodes[2].execute(parser, caller, local)
-        else:
-            return expr <= self.nodes[2].execute(parser, caller, local)
-
-
+        self.left.print()
+        print(f'{self.op.value}', end='')
+        self.right.print()
+
+    def reads(self):
+        return self.left.reads() | self.right.reads()
+
+    # Binds one closure per comparator so the operator token is not
+    # checked on every evaluation. Every variant returns a bool, which
+    # Cond relies on to short circuit OR chains
+    def compile(self, cached=None):
+        left, right = self.left.compile(cached), self.right.compile(cached)
+        if self.op is Token.LESS:
+            return lambda parser, caller=None, local=None: \
+                left(parser, caller, local) < right(parser, caller, local)
+        elif self.op is Token.EQUAL:
+            return lambda parser, caller=None, local=None: \
+                left(parser, caller, local) == right(parser, caller, local)
+        return lambda parser, caller=None, local=None: \
+            left(parser, caller, local) <= right(parser, caller, local)
+
+
+# Constant literal
+#   text        -   literal as read by the scanner, kept for printing
+#   value       -   integer value, converted once at parse
 class Const:
+    __slots__ = ('text', 'value')
+
     def __init__(self):
-        self.nodes = []
+        self.text = None
+        self.value = None
 
     def parse(self, parser):
         parser.token_validate(Token.CONST)
-        self.nodes.append(parser.get_const())
+        self.text = parser.get_const()
+        self.value = int(self.text)
         parser.next_token()
 
     @staticmethod
@@ -795,22 +1110,64 @@ class Const:
         return True
 
     def print(self, indent=None):
-        for node in self.nodes:
-            if type(node) is not Token:
-                print(f'{node}', end='')
+        print(f'{self.text}', end='')
+
+    @staticmethod
+    def reads():
+        return set()
+
+    def source(self, env, cached=None):
+        return repr(self.value)
+
+    def compile(self, cached=None):
+        return self.execute
 
     def execute(self, parser, caller=None, local=None):
-        for node in self.nodes:
-            if node is not Token:
-                return int(node)
+        return self.value
 
 
-# Class representation of the nested scopes. Each layer consists of
-# two member elements, a dictionary to access by variable name and
-# a key. Child points to the next scope in the stack
-#   dict        -   dictionary of variable:value pairs
+# Class representation of the nested scopes. Each layer holds one
+# slot per interned id, indexed by Id.idx, and a mask of which ids
+# are declared in this layer. Child points to the next scope in the
+# stack, parent back to the enclosing one so lookups can climb from
+# the innermost scope
+#   slots       -   variable values by id index
+#   mask        -   True where the id is declared in this scope
+#   declared    -   indices set in mask, so clear only touches those
 #   child       -   reference to the next tuple, instantiated as None
+#   parent      -   reference to the enclosing tuple, None at the root
 class scope_tree:
-    def __init__(self):
-        self.dict = dict()
+    __slots__ = ('slots', 'mask', 'declared', 'child', 'parent')
+
+    def __init__(self, size=0):
+        self.slots = [None] * size
+        self.mask = [False] * size
+        self.declared = []
         self.child = None
+        self.parent = None
+
+    # Marks an id as declared in this scope with an initial value
+    def declare(self, idx, value):
+        self.mask[idx], self.slots[idx] = True, value
+        self.declared.append(idx)
+
+    # Resets the scope for reuse. Each If/While/Program node keeps one
+    # scope and clears it on entry rather than allocating a new one,
+    # which is safe since the grammar has no recursion
+    def clear(self):
+        for idx in self.declared:
+            self.mask[idx], self.slots[idx] = False, None
+        self.declared.clear()
+        self.child = None
+
+
+# Statement class for each token that can start a statement, used by
+# StmtSeq.parse in place of an if/elif chain
+_STMT_DISPATCH = {
+    Token.ID: Assign,
+    Token.INPUT: Input,
+    Token.OUTPUT: Output,
+    Token.IF: If,
+    Token.WHILE: While,
+    Token.INT: Decl,
+}
@@ -116,8 +116,10 @@ bool inline is_number(const std::string& str) {
 }
 
 struct token_t next_token(const char *f_name, long pos) {
-    // Declare temp sting, and token_t
+    // Declare temp sting, and token_t. The token and name strings are static so
+    // the C strings handed back to Python stay valid until the next call
     std::string name;
+    static std::string token_str, name_str;
     token_t ret;
     // Reserve memory space so pair memory is not lost when first/second are passed to
     // token_t constructor
@@ -131,10 +133,11 @@ struct token_t next_token(const char *f_name, long pos) {
 
     // Classify token as CONST, ID, or other
     if(is_number(token->first)) {
-        ret = token_t(resolve_token(std::string("const")), token->first, token->second);
+        token_str = resolve_token(std::string("const")), name_str = token->first;
     } else if((name = resolve_token(token->first)) == "ID") {
-        ret = token_t(name, token->first, token->second);
-    } else ret = token_t(name, NONE, token->second);
+        token_str = name, name_str = token->first;
+    } else token_str = name, name_str = NONE;
+    ret = token_t(token_str, name_str, token->second);
 
     // Return token_t struct and clear reserved memory
     delete token;